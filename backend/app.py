@@ -1,21 +1,37 @@
 import os
 import io
+import re
+import html
+import math
+import time
 import uuid
+import hashlib
+import logging
+import multiprocessing
+import asyncio
+import heapq
+import itertools
 import tempfile
-from typing import List, Dict, Any, Optional
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional, Set, Tuple, TYPE_CHECKING
 
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-# LangChain + loaders + vectorstore
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain.chains import ConversationalRetrievalChain
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+
+PROCESS_START = time.monotonic()
+
+logger = logging.getLogger(__name__)
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
 
@@ -23,8 +39,82 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise RuntimeError("GOOGLE_API_KEY is not set. Put it in backend/.env")
 
+# LangChain, FAISS and the Google SDK take seconds to import, so they are
+# loaded on first use (or by the warm-up task) instead of at module load.
+@lru_cache(maxsize=None)
+def _lc() -> SimpleNamespace:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_community.vectorstores import FAISS
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
+    from langchain.chains import ConversationalRetrievalChain
+
+    return SimpleNamespace(
+        RecursiveCharacterTextSplitter=RecursiveCharacterTextSplitter,
+        PyPDFLoader=PyPDFLoader,
+        FAISS=FAISS,
+        GoogleGenerativeAIEmbeddings=GoogleGenerativeAIEmbeddings,
+        ChatGoogleGenerativeAI=ChatGoogleGenerativeAI,
+        ConversationalRetrievalChain=ConversationalRetrievalChain,
+    )
+
+@lru_cache(maxsize=None)
+def _get_embeddings():
+    return _lc().GoogleGenerativeAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        google_api_key=GOOGLE_API_KEY,
+    )
+
+@lru_cache(maxsize=None)
+def _get_llm():
+    return _lc().ChatGoogleGenerativeAI(
+        model="models/gemini-1.5-flash",
+        google_api_key=GOOGLE_API_KEY,
+        temperature=0.2,
+    )
+
+# Warm-up state reported by /ready
+WARMUP: Dict[str, Any] = {"ready": False, "running": False, "error": None, "seconds": None}
+
+def _warm_up():
+    # Failures are not cached by lru_cache, so a later call retries from scratch
+    WARMUP["running"] = True
+    t0 = time.monotonic()
+    try:
+        _lc()
+        _get_embeddings()
+        _get_llm()
+    except Exception as e:
+        WARMUP["error"] = str(e)
+        return
+    finally:
+        WARMUP["running"] = False
+    WARMUP["error"] = None
+    WARMUP["seconds"] = round(time.monotonic() - t0, 3)
+    WARMUP["ready"] = True
+
+# Strong references to fire-and-forget tasks; the event loop only keeps weak ones
+BACKGROUND_TASKS: set = set()
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up after the server binds so /health answers immediately
+    warmup_task = asyncio.create_task(asyncio.to_thread(_warm_up))
+    yield
+    warmup_task.cancel()
+    if _ocr_pool.cache_info().currsize:
+        pool = _ocr_pool()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
 # FastAPI
-app = FastAPI(title="Chat with Multiple PDFs (Gemini 1.5 Flash)")
+app = FastAPI(title="Chat with Multiple PDFs (Gemini 1.5 Flash)", lifespan=lifespan)
 
 # CORS
 origins = os.getenv("CORS_ORIGINS", "http://localhost:8000").split(",")
@@ -41,24 +131,717 @@ SESSIONS: Dict[str, Dict[str, Any]] = {}
 # structure:
 # {
 #   session_id: {
-#       "vectorstore": FAISS,
-#       "history": List[tuple[str, str]]
+#       "index": DocumentIndex,
+#       "docset_key": str,
+#       "documents": List[dict],  # per-document ingestion stats
+#       "history": ChatMemory
 #   }
 # }
 
+# Page stores by doc_id (content hash), shared by every session that uploaded the file
+DOCUMENTS: Dict[str, "PageStore"] = {}
+
+# Ingestion settings (part of the upload dedup key)
+CHUNK_SIZE = 1200
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "models/embedding-001"
+
+# Pages with less extractable text than this are treated as scanned/image-only
+MIN_PAGE_CHARS = int(os.getenv("MIN_PAGE_CHARS", "20"))
+MIN_CHUNK_CHARS = 20
+# Optional OCR fallback for scanned pages (needs pytesseract, Pillow and the tesseract binary)
+OCR_ENABLED = os.getenv("OCR_ENABLED", "false").lower() in ("1", "true", "yes")
+OCR_MAX_WORKERS = int(os.getenv("OCR_MAX_WORKERS", "2"))
+
+# Boilerplate removal: lines near the top/bottom of a page that recur on at
+# least this fraction of a document's pages are stripped as headers/footers
+BOILERPLATE_EDGE_LINES = 3
+BOILERPLATE_MIN_FRACTION = 0.5
+# Chunks whose SimHash fingerprints differ by at most this many bits are
+# merge candidates; a candidate is merged only if the word 3-gram Jaccard
+# similarity reaches DEDUP_MIN_JACCARD and both chunks contain the same numbers
+SIMHASH_MAX_DISTANCE = 3
+DEDUP_MIN_JACCARD = 0.95
+
+# Query routing: chunk search only runs in the documents whose centroid
+# embeddings are closest to the question
+ROUTE_TOP_DOCS = int(os.getenv("ROUTE_TOP_DOCS", "5"))
+RETRIEVAL_K = 4
+
+# Chat memory limits (per session)
+HISTORY_WINDOW_TURNS = int(os.getenv("HISTORY_WINDOW_TURNS", "6"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+
+def _count_tokens(text: str) -> int:
+    # Rough estimate (~4 chars per token); avoids a tokenizer round-trip per turn
+    return (len(text) + 3) // 4
+
+class ChatMemory:
+    """Sliding window of recent turns plus a running summary of older ones.
+
+    When the window exceeds ``max_turns`` or the history exceeds
+    ``token_budget``, it is shrunk to about half in one go and the evicted
+    turns are folded into the summary with a single LLM call, so the
+    summary is refreshed every few turns rather than on every question.
+    """
+
+    def __init__(self, max_turns: int = HISTORY_WINDOW_TURNS, token_budget: int = HISTORY_TOKEN_BUDGET):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.turns: List[Tuple[str, str]] = []
+        self.summary = ""
+        self.prompt_tokens = 0
+        self.answer_tokens = 0
+        self.summary_tokens = 0
+        self.summarizations = 0
+        # Concurrent /ask calls on one session update the memory from worker threads
+        self._lock = threading.Lock()
+        self._summary_lock = threading.Lock()
+        # Bumped by clear(); a summary started before a reset is discarded
+        self._generation = 0
+
+    @staticmethod
+    def _turn_tokens(turn: Tuple[str, str]) -> int:
+        return _count_tokens(turn[0]) + _count_tokens(turn[1])
+
+    def history_tokens(self) -> int:
+        return _count_tokens(self.summary) + sum(self._turn_tokens(t) for t in self.turns)
+
+    def chat_history(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            history = list(self.turns)
+            if self.summary:
+                history.insert(0, ("Summarize our conversation so far.", self.summary))
+        return history
+
+    def add_turn(self, question: str, answer: str, prompt_tokens: int) -> List[Tuple[str, str]]:
+        """Record a turn. Returns the turns evicted from the window, which the
+        caller should pass to ``summarize``."""
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.answer_tokens += _count_tokens(answer)
+            self.turns.append((question, answer))
+            if len(self.turns) <= self.max_turns and self.history_tokens() <= self.token_budget:
+                return []
+
+            keep_turns = max(self.max_turns // 2, 1)
+            evicted = []
+            while len(self.turns) > 1 and (
+                len(self.turns) > keep_turns or self.history_tokens() > self.token_budget // 2
+            ):
+                evicted.append(self.turns.pop(0))
+            return evicted
+
+    def summarize(self, evicted: List[Tuple[str, str]]):
+        if not evicted:
+            return
+        transcript = "\n".join(f"User: {q}\nAssistant: {a}" for q, a in evicted)
+        max_words = max(self.token_budget // 6, 50)
+        # Summaries are applied one at a time; _lock is never held across the LLM call
+        with self._summary_lock:
+            with self._lock:
+                generation = self._generation
+            prompt = (
+                "Update the running summary of a conversation about some PDF documents.\n"
+                f"Keep it under {max_words} words and keep facts the user may refer back to.\n\n"
+                f"Current summary:\n{self.summary or '(empty)'}\n\n"
+                f"New turns:\n{transcript}\n\nUpdated summary:"
+            )
+            try:
+                summary = _get_llm().invoke(prompt).content.strip()
+            except Exception:
+                # Keep the previous summary rather than failing the request
+                return
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self.summary = summary
+                self.summary_tokens += _count_tokens(prompt) + _count_tokens(summary)
+                self.summarizations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.turns = []
+            self.summary = ""
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "turns_in_window": len(self.turns),
+            "history_tokens": self.history_tokens(),
+            "prompt_tokens": self.prompt_tokens,
+            "answer_tokens": self.answer_tokens,
+            "summary_tokens": self.summary_tokens,
+            "summarizations": self.summarizations,
+        }
+
 class AskBody(BaseModel):
     session_id: str
     question: str
+    # Optional retrieval filters; pages are numbered as in the returned sources
+    filenames: Optional[List[str]] = None
+    page_from: Optional[int] = None
+    page_to: Optional[int] = None
 
 class ResetBody(BaseModel):
     session_id: str
 
-def _build_vectorstore_from_pdfs(files: List[UploadFile]) -> FAISS:
+class SingleFlight:
+    """Coalesce identical concurrent calls: the first caller for a key awaits
+    ``make_coro()``, later callers await the same result."""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def pending(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: str, make_coro):
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await make_coro()
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # mark retrieved when nobody else is waiting
+            raise
+        except BaseException:
+            fut.cancel()
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+UPLOAD_FLIGHTS = SingleFlight()
+ASK_FLIGHTS = SingleFlight()
+# (session_id, ask key) pairs with a caller that will record the turn
+PENDING_TURNS: set = set()
+
+# Scheduling: interactive /ask work is served ahead of bulk /upload work
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+SCHEDULER_SLOTS = int(os.getenv("SCHEDULER_SLOTS", "4"))
+
+# Per-tenant token buckets (tokens per second, burst size)
+ASK_RATE = float(os.getenv("ASK_RATE", "0.5"))
+ASK_BURST = float(os.getenv("ASK_BURST", "5"))
+UPLOAD_RATE = float(os.getenv("UPLOAD_RATE", "0.2"))  # one token per PDF
+UPLOAD_BURST = float(os.getenv("UPLOAD_BURST", "10"))
+
+# X-API-Key values accepted as tenant identities; anything else falls back to
+# the browser's X-Client-Id, the session or the client IP so random keys
+# cannot mint fresh buckets
+API_KEYS = {k.strip() for k in os.getenv("API_KEYS", "").split(",") if k.strip()}
+
+# Optional per-key weights, e.g. "team-key:3,batch-key:0.5" (keys must be in API_KEYS)
+TENANT_WEIGHTS: Dict[str, float] = {
+    k.strip(): float(w)
+    for k, _, w in (item.partition(":") for item in os.getenv("TENANT_WEIGHTS", "").split(","))
+    if k.strip() and w
+}
+
+# How often idle buckets and fair-queuing tags are swept
+SWEEP_INTERVAL = 60.0
+
+METRICS: Dict[str, Any] = {
+    "queue_wait": {
+        kind: {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        for kind in ("ask", "upload")
+    },
+    "rate_limited": {"ask": 0, "upload": 0},
+}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost: float = 1.0) -> float:
+        """Consume ``cost`` tokens. Returns 0 on success, else seconds until they are available.
+
+        A cost above the capacity can never be saved up for, so it is admitted
+        on a full bucket and leaves the bucket in debt.
+        """
+        self._refill()
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (needed - self.tokens) / self.rate
+
+    def charge(self, cost: float = 1.0):
+        """Consume ``cost`` tokens unconditionally; the bucket may go into debt."""
+        self._refill()
+        self.tokens -= cost
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+BUCKETS: Dict[Tuple[str, str], TokenBucket] = {}
+_LAST_SWEEP = [time.monotonic()]
+
+def _sweep_idle_state():
+    # A full bucket or a finish tag behind virtual time behaves exactly like a new one
+    now = time.monotonic()
+    if now - _LAST_SWEEP[0] < SWEEP_INTERVAL:
+        return
+    _LAST_SWEEP[0] = now
+    for key in [k for k, bucket in BUCKETS.items() if bucket.is_full()]:
+        del BUCKETS[key]
+    SCHEDULER.prune()
+
+def _bucket(tenant: str, kind: str) -> TokenBucket:
+    _sweep_idle_state()
+    rate, burst = (ASK_RATE, ASK_BURST) if kind == "ask" else (UPLOAD_RATE, UPLOAD_BURST)
+    bucket = BUCKETS.get((tenant, kind))
+    if bucket is None:
+        bucket = BUCKETS[(tenant, kind)] = TokenBucket(rate, burst)
+    return bucket
+
+def _rate_limit(tenant: str, kind: str, cost: float = 1.0) -> Optional[JSONResponse]:
+    wait = _bucket(tenant, kind).take(cost)
+    if not wait:
+        return None
+    METRICS["rate_limited"][kind] += 1
+    retry_after = str(math.ceil(wait)) if math.isfinite(wait) else "3600"
+    return JSONResponse(
+        status_code=429,
+        content={"error": f"Rate limit exceeded for {kind}. Retry in {retry_after}s."},
+        headers={"Retry-After": retry_after},
+    )
+
+def _tenant(request: Request, session_id: Optional[str] = None) -> str:
+    api_key = request.headers.get("x-api-key")
+    if api_key and api_key in API_KEYS:
+        return f"key:{api_key}"
+    # Per-browser id sent by the frontend; every Streamlit user shares its IP
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return f"browser:{client_id[:64]}"
+    if session_id:
+        return f"session:{session_id}"
+    return f"client:{request.client.host if request.client else 'unknown'}"
+
+class FairScheduler:
+    """Bounded worker slots shared between tenants.
+
+    Waiting work is ordered by priority, then by start-time fair queuing
+    tags: each tenant's tag advances by ``cost / weight`` per item, so a
+    tenant submitting 40 PDFs cannot starve others with the same priority.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active = 0
+        self._heap: List[list] = []
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._finish: Dict[str, float] = {}
+
+    async def _acquire(self, tenant: str, priority: int, cost: float):
+        kind, _, name = tenant.partition(":")
+        weight = TENANT_WEIGHTS.get(name, 1.0) if kind == "key" else 1.0
+        start = max(self._vtime, self._finish.get(tenant, 0.0))
+        self._finish[tenant] = start + cost / weight
+        if self.active < self.slots and not self._heap:
+            self.active += 1
+            self._vtime = start
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, [priority, start, next(self._seq), fut])
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release()  # slot was handed over just before cancellation
+            else:
+                fut.cancel()
+            raise
+
+    def prune(self):
+        # Tags behind virtual time are equivalent to no tag at all
+        for tenant in [t for t, finish in self._finish.items() if finish <= self._vtime]:
+            del self._finish[tenant]
+
+    def _release(self):
+        while self._heap:
+            _, start, _, fut = heapq.heappop(self._heap)
+            if fut.cancelled():
+                continue
+            # Hand the slot straight to the next waiter
+            self._vtime = start
+            fut.set_result(None)
+            return
+        self.active -= 1
+
+    async def run(self, tenant: str, kind: str, priority: int, cost: float, fn, *args):
+        t0 = time.monotonic()
+        await self._acquire(tenant, priority, cost)
+        waited = time.monotonic() - t0
+        stats = METRICS["queue_wait"][kind]
+        stats["count"] += 1
+        stats["total_seconds"] += waited
+        stats["max_seconds"] = max(stats["max_seconds"], waited)
+        try:
+            return await asyncio.to_thread(fn, *args)
+        finally:
+            self._release()
+
+SCHEDULER = FairScheduler(SCHEDULER_SLOTS)
+
+def _docset_key(pdfs: List[Tuple[str, bytes]]) -> str:
+    h = hashlib.sha256(f"{CHUNK_SIZE}:{CHUNK_OVERLAP}:{EMBEDDING_MODEL}:{OCR_ENABLED}".encode())
+    for name, digest in sorted((name, _doc_id(data)) for name, data in pdfs):
+        h.update(f"{name}\0{digest}\0".encode())
+    return h.hexdigest()
+
+def _ingestion_version() -> str:
+    # Page texts and chunk spans depend on these settings as well as the file bytes
+    settings = f"{CHUNK_SIZE}:{CHUNK_OVERLAP}:{MIN_PAGE_CHARS}:{MIN_CHUNK_CHARS}:{OCR_ENABLED}"
+    return hashlib.sha256(settings.encode()).hexdigest()[:8]
+
+def _doc_id(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:16]
+
+def _ask_key(docset_key: str, question: str, chat_history: List[Tuple[str, str]], filters: str = "") -> str:
+    h = hashlib.sha256(docset_key.encode())
+    for part in [question, filters, *(p for turn in chat_history for p in turn)]:
+        h.update(b"\0" + part.encode())
+    return h.hexdigest()
+
+def _ocr_page(page_pdf: bytes) -> str:
+    # Runs in a worker process; scanned pages are usually one embedded image each
+    import pytesseract
+    from pypdf import PdfReader
+
+    page = PdfReader(io.BytesIO(page_pdf)).pages[0]
+    return "\n".join(pytesseract.image_to_string(img.image) for img in page.images)
+
+@lru_cache(maxsize=None)
+def _ocr_pool() -> Optional[ProcessPoolExecutor]:
+    if not OCR_ENABLED:
+        return None
+    try:
+        import pytesseract  # noqa: F401
+    except ImportError:
+        logger.warning("OCR_ENABLED is set but pytesseract is not installed; scanned pages will be skipped")
+        return None
+    # The pool is created from a worker thread of a multi-threaded server, where
+    # fork can deadlock; forkserver/spawn start clean child processes
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    # The pool size bounds how many pages are OCR'd at once across all uploads
+    return ProcessPoolExecutor(max_workers=OCR_MAX_WORKERS, mp_context=context)
+
+def _ocr_pages(data: bytes, page_indexes: Set[int]) -> Dict[int, str]:
+    pool = _ocr_pool()
+    if pool is None or not page_indexes:
+        return {}
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(io.BytesIO(data))
+    futures = {}
+    for i in sorted(page_indexes):
+        # Ship single-page PDFs to the workers rather than the whole file
+        writer = PdfWriter()
+        writer.add_page(reader.pages[i])
+        buf = io.BytesIO()
+        writer.write(buf)
+        futures[i] = pool.submit(_ocr_page, buf.getvalue())
+
+    texts = {}
+    for i, fut in futures.items():
+        try:
+            texts[i] = fut.result()
+        except Exception as e:
+            # e.g. the tesseract binary is missing; the page is then counted as skipped
+            logger.warning("OCR failed for page %d: %s", i, e)
+    return texts
+
+def _norm_line(line: str) -> str:
+    # Page numbers and dates vary between otherwise identical headers/footers
+    return re.sub(r"\d+", "#", " ".join(line.lower().split()))
+
+def _strip_boilerplate(pages: List[Any]) -> int:
+    """Remove recurring header/footer lines from a document's pages in place.
+    Returns the number of lines removed."""
+    if len(pages) < 3:
+        return 0
+
+    def edge_indexes(lines: List[str]) -> List[int]:
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        # Leave at least a third of a short page out of the edge region
+        n = min(BOILERPLATE_EDGE_LINES, len(filled) // 3)
+        return filled[:n] + filled[len(filled) - n:] if n else []
+
+    counts: Counter = Counter()
+    for d in pages:
+        lines = d.page_content.splitlines()
+        counts.update({_norm_line(lines[i]) for i in edge_indexes(lines)})
+    threshold = max(2, len(pages) * BOILERPLATE_MIN_FRACTION)
+    boilerplate = {line for line, n in counts.items() if n >= threshold}
+    if not boilerplate:
+        return 0
+
+    removed = 0
+    for d in pages:
+        lines = d.page_content.splitlines()
+        drop = {i for i in edge_indexes(lines) if _norm_line(lines[i]) in boilerplate}
+        removed += len(drop)
+        d.page_content = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+    return removed
+
+def _shingles(words: List[str]) -> List[str]:
+    return [" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+
+def _simhash(shingles: List[str]) -> int:
+    import numpy as np
+
+    digests = b"".join(hashlib.blake2b(sh.encode(), digest_size=8).digest() for sh in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(-1, 64)
+    votes = bits.sum(axis=0) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(votes).tobytes(), "big")
+
+def _is_near_duplicate(a: Tuple[List[str], Set[str]], b: Tuple[List[str], Set[str]]) -> bool:
+    words_a, shingles_a = a
+    words_b, shingles_b = b
+    if words_a == words_b:
+        return True
+    # Differing figures (e.g. one year's table vs another's) are real content
+    if sorted(w for w in words_a if w.isdigit()) != sorted(w for w in words_b if w.isdigit()):
+        return False
+    union = len(shingles_a | shingles_b)
+    return bool(union) and len(shingles_a & shingles_b) / union >= DEDUP_MIN_JACCARD
+
+def _dedup_chunks(chunks: List[Any]) -> List[Any]:
+    """Collapse near-identical chunks into the first occurrence.
+
+    The kept chunk's ``locations`` metadata lists every (file, page) it was
+    seen at. Candidates are found via four 16-bit bands of the SimHash
+    fingerprint, which by pigeonhole catches every pair within 3 differing
+    bits, and are then confirmed on the actual text.
+    """
+    kept: List[Tuple[int, Tuple[List[str], Set[str]], Any]] = []
+    bands: Dict[Tuple[int, int], List[int]] = {}
+    for chunk in chunks:
+        words = re.findall(r"\w+", chunk.page_content.lower())
+        shingles = _shingles(words)
+        text = (words, set(shingles))
+        fp = _simhash(shingles)
+        location = {
+            "doc_id": chunk.metadata.get("doc_id"),
+            "filename": chunk.metadata.get("filename"),
+            "page": chunk.metadata.get("page"),
+            "chunk_id": chunk.metadata.get("chunk_id"),
+        }
+        keys = [(b, (fp >> (16 * b)) & 0xFFFF) for b in range(4)]
+        match = None
+        for key in keys:
+            for idx in bands.get(key, []):
+                other_fp, other_text, _ = kept[idx]
+                if bin(fp ^ other_fp).count("1") <= SIMHASH_MAX_DISTANCE and _is_near_duplicate(text, other_text):
+                    match = idx
+                    break
+            if match is not None:
+                break
+        if match is not None:
+            original = kept[match][2]
+            if location not in original.metadata["locations"]:
+                original.metadata["locations"].append(location)
+            chunk.metadata["duplicate"] = True
+            continue
+        chunk.metadata["locations"] = [location]
+        for key in keys:
+            bands.setdefault(key, []).append(len(kept))
+        kept.append((fp, text, chunk))
+    return [chunk for _, _, chunk in kept]
+
+class DocumentIndex:
+    """Two-level index over a session's PDFs.
+
+    Every document gets its own FAISS store and a centroid of its chunk
+    embeddings. A question is first routed to the ``top_docs`` documents
+    whose centroids are closest, and only their stores are searched, so
+    cost grows with the relevant documents rather than the whole corpus.
+    """
+
+    def __init__(self, embeddings, stores: Dict[str, "FAISS"], centroids: Dict[str, Any],
+                 filenames: Dict[str, str], top_docs: int = ROUTE_TOP_DOCS):
+        self.embeddings = embeddings
+        self.stores = stores
+        self.centroids = centroids
+        self.filenames = filenames
+        self.top_docs = top_docs
+
+    @classmethod
+    def build(cls, chunks: List[Any], embeddings) -> "DocumentIndex":
+        import numpy as np
+
+        texts = [c.page_content for c in chunks]
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+        # A merged duplicate chunk is indexed under every document it came from
+        by_doc: Dict[str, List[int]] = {}
+        filenames: Dict[str, str] = {}
+        for i, chunk in enumerate(chunks):
+            for loc in chunk.metadata["locations"]:
+                idxs = by_doc.setdefault(loc["doc_id"], [])
+                if not idxs or idxs[-1] != i:
+                    idxs.append(i)
+                filenames.setdefault(loc["doc_id"], loc["filename"])
+
+        stores, centroids = {}, {}
+        for doc_id, idxs in by_doc.items():
+            stores[doc_id] = _lc().FAISS.from_embeddings(
+                [(texts[i], vectors[i].tolist()) for i in idxs],
+                embeddings,
+                metadatas=[chunks[i].metadata for i in idxs],
+            )
+            centroid = _unit(vectors[idxs]).mean(axis=0)
+            centroids[doc_id] = centroid / max(float(np.linalg.norm(centroid)), 1e-12)
+        return cls(embeddings, stores, centroids, filenames)
+
+    def search(self, query: str, k: int = RETRIEVAL_K, filenames: Optional[List[str]] = None,
+               page_range: Optional[Tuple[float, float]] = None) -> List[Any]:
+        import numpy as np
+
+        doc_ids = list(self.stores)
+        if filenames:
+            doc_ids = [d for d in doc_ids if self.filenames[d] in filenames]
+        if not doc_ids:
+            return []
+
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        if len(doc_ids) > self.top_docs:
+            q = _unit(query_vector[None, :])[0]
+            doc_ids.sort(key=lambda d: -float(self.centroids[d] @ q))
+            doc_ids = doc_ids[:self.top_docs]
+
+        hits = []
+        for doc_id in doc_ids:
+            store = self.stores[doc_id]
+            if page_range:
+                # Filter before the top-k cut: the flat index scores every vector
+                # anyway, so fetching all of them only adds the metadata check
+                found = store.similarity_search_with_score_by_vector(
+                    query_vector.tolist(), k=k,
+                    filter=partial(_in_page_range, doc_id=doc_id, page_range=page_range),
+                    fetch_k=store.index.ntotal,
+                )
+            else:
+                found = store.similarity_search_with_score_by_vector(query_vector.tolist(), k=k)
+            for doc, distance in found:
+                # A merged chunk is cited at its location in the document being searched
+                location = next(
+                    (
+                        loc for loc in doc.metadata["locations"]
+                        if loc["doc_id"] == doc_id
+                        and (not page_range or page_range[0] <= loc["page"] <= page_range[1])
+                    ),
+                    None,
+                )
+                if location is None:
+                    continue
+                if location["chunk_id"] != doc.metadata.get("chunk_id"):
+                    doc = type(doc)(page_content=doc.page_content, metadata={**doc.metadata, **location})
+                hits.append((distance, doc))
+
+        # Every store uses the same L2 metric, so distances are comparable
+        hits.sort(key=lambda hit: hit[0])
+        results, seen = [], set()
+        for _, doc in hits:
+            if doc.page_content in seen:
+                continue
+            seen.add(doc.page_content)
+            results.append(doc)
+            if len(results) == k:
+                break
+        return results
+
+def _in_page_range(metadata: Dict[str, Any], doc_id: str, page_range: Tuple[float, float]) -> bool:
+    return any(
+        loc["doc_id"] == doc_id and page_range[0] <= loc["page"] <= page_range[1]
+        for loc in metadata["locations"]
+    )
+
+def _unit(vectors):
+    import numpy as np
+
+    return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+@lru_cache(maxsize=None)
+def _routed_retriever_cls():
+    from langchain_core.retrievers import BaseRetriever
+
+    class RoutedRetriever(BaseRetriever):
+        index: Any
+        k: int = RETRIEVAL_K
+        filenames: Optional[List[str]] = None
+        page_range: Optional[Tuple[float, float]] = None
+
+        def _get_relevant_documents(self, query: str, *, run_manager) -> List[Any]:
+            return self.index.search(query, self.k, self.filenames, self.page_range)
+
+    return RoutedRetriever
+
+class PageStore:
+    """Per-document page text, page offsets and chunk spans built at ingestion.
+
+    Pages are stored back to back in one string; ``offsets`` maps a page
+    number to its slice and ``chunk_spans`` maps a chunk_id to its
+    page-relative span, so serving a highlighted page is O(1).
+    """
+
+    def __init__(self, doc_id: str, filename: str, pages: List[Any]):
+        self.doc_id = doc_id
+        self.filename = filename
+        self.offsets: Dict[int, Tuple[int, int]] = {}
+        parts, pos = [], 0
+        for d in pages:
+            self.offsets[d.metadata["page"]] = (pos, pos + len(d.page_content))
+            parts.append(d.page_content)
+            pos += len(d.page_content)
+        self.text = "".join(parts)
+        self.chunk_spans: Dict[str, Tuple[int, int, int]] = {}
+
+    def add_chunk(self, chunk):
+        start = chunk.metadata.get("start_index", -1)
+        if start >= 0:
+            self.chunk_spans[chunk.metadata["chunk_id"]] = (
+                chunk.metadata["page"], start, start + len(chunk.page_content),
+            )
+
+    def page(self, n: int) -> Optional[str]:
+        span = self.offsets.get(n)
+        return self.text[span[0]:span[1]] if span else None
+
+def _build_index_from_pdfs(pdfs: List[Tuple[str, bytes]]) -> Tuple[DocumentIndex, List[Dict[str, Any]], List[PageStore]]:
+    lc = _lc()
     # Load PDFs
     documents = []
-    for uf in files:
-        # Read into memory and feed to PyPDFLoader via temp file-like
-        data = uf.file.read()
+    doc_stats = []
+    page_stores: Dict[str, PageStore] = {}
+    for name, data in pdfs:
+        doc_id = _doc_id(data)
+        if doc_id in page_stores:
+            continue  # the same file twice in one upload
         bio = io.BytesIO(data)
         
         # Use tempfile module for cross-platform compatibility
@@ -67,9 +850,8 @@ def _build_vectorstore_from_pdfs(files: List[UploadFile]) -> FAISS:
             tmp_file.write(bio.getbuffer())
         
         try:
-            loader = PyPDFLoader(tmp_path)
+            loader = lc.PyPDFLoader(tmp_path)
             docs = loader.load()
-            documents.extend(docs)
         finally:
             # Clean up temporary file
             try:
@@ -77,78 +859,167 @@ def _build_vectorstore_from_pdfs(files: List[UploadFile]) -> FAISS:
             except Exception:
                 pass
 
+        # Image-only pages come back (nearly) empty; try OCR, otherwise drop them
+        low_text = {i for i, d in enumerate(docs) if len(d.page_content.strip()) < MIN_PAGE_CHARS}
+        ocr_texts = _ocr_pages(data, low_text)
+        stats = {"doc_id": doc_id, "filename": name, "pages": len(docs), "text_pages": len(docs) - len(low_text),
+                 "ocr_pages": 0, "skipped_pages": 0}
+        pages = []
+        for i, d in enumerate(docs):
+            if i in low_text:
+                text = ocr_texts.get(i, "")
+                if len(text.strip()) < MIN_PAGE_CHARS:
+                    stats["skipped_pages"] += 1
+                    continue
+                d.page_content = text
+                d.metadata["ocr"] = True
+                stats["ocr_pages"] += 1
+            d.metadata["doc_id"] = doc_id
+            d.metadata["filename"] = name
+            pages.append(d)
+        stats["boilerplate_lines"] = _strip_boilerplate(pages)
+        page_stores[doc_id] = PageStore(doc_id, name, pages)
+        documents.extend(pages)
+        doc_stats.append(stats)
+
     # Split
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1200,
-        chunk_overlap=200,
+    splitter = lc.RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
         separators=["\n\n", "\n", " ", ""],
+        add_start_index=True,
     )
-    splits = splitter.split_documents(documents)
+    splits = [d for d in splitter.split_documents(documents) if len(d.page_content.strip()) >= MIN_CHUNK_CHARS]
+    if not splits:
+        raise ValueError("No extractable text found in the uploaded PDFs")
+    # Numbered per document so a chunk_id depends only on the file's contents
+    counters: Counter = Counter()
+    for chunk in splits:
+        doc_id = chunk.metadata["doc_id"]
+        chunk.metadata["chunk_id"] = f"{doc_id}:{counters[doc_id]}"
+        counters[doc_id] += 1
+        page_stores[doc_id].add_chunk(chunk)
 
-    # Embeddings (Google)
-    embeddings = GoogleGenerativeAIEmbeddings(
-        model="models/embedding-001",
-        google_api_key=GOOGLE_API_KEY,
-    )
+    # Near-duplicate chunks (within and across files) are embedded once
+    unique = _dedup_chunks(splits)
+    for stats in doc_stats:
+        mine = [d for d in splits if d.metadata["doc_id"] == stats["doc_id"]]
+        stats["chunks"] = len(mine)
+        stats["duplicate_chunks"] = sum(1 for d in mine if d.metadata.get("duplicate"))
+    splits = unique
 
-    # Vectorstore
-    vectorstore = FAISS.from_documents(splits, embedding=embeddings)
-    return vectorstore
+    # Per-document stores + routing layer (embeddings client is shared across uploads)
+    index = DocumentIndex.build(splits, _get_embeddings())
+    return index, doc_stats, list(page_stores.values())
 
-def _get_or_create_chain(session_id: str):
+def _get_or_create_chain(session_id: str, filenames: Optional[List[str]] = None,
+                         page_from: Optional[int] = None, page_to: Optional[int] = None):
     sess = SESSIONS.get(session_id)
     if not sess:
         raise ValueError("Invalid session_id. Upload PDFs first.")
-    vectorstore: FAISS = sess["vectorstore"]
-    history: List = sess["history"]
+    index: DocumentIndex = sess["index"]
+    history: ChatMemory = sess["history"]
 
-    retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": 4},
+    page_range = None
+    if page_from is not None or page_to is not None:
+        page_range = (
+            page_from if page_from is not None else 0,
+            page_to if page_to is not None else float("inf"),
+        )
+    retriever = _routed_retriever_cls()(
+        index=index, k=RETRIEVAL_K, filenames=filenames or None, page_range=page_range,
     )
 
-    llm = ChatGoogleGenerativeAI(
-        model="models/gemini-1.5-flash",
-        google_api_key=GOOGLE_API_KEY,
-        temperature=0.2,
-    )
-
-    chain = ConversationalRetrievalChain.from_llm(
-        llm=llm,
+    chain = _lc().ConversationalRetrievalChain.from_llm(
+        llm=_get_llm(),
         retriever=retriever,
         return_source_documents=True,
     )
     return chain, history
 
 @app.post("/upload")
-async def upload_pdfs(files: List[UploadFile] = File(...)):
+async def upload_pdfs(request: Request, files: List[UploadFile] = File(...)):
     if not files:
         return JSONResponse(status_code=400, content={"error": "No files uploaded"})
 
+    pdfs = [(uf.filename, await uf.read()) for uf in files]
+    docset_key = _docset_key(pdfs)
+
+    # Callers joining an ingestion already in flight add no work, so they are not charged
+    tenant = _tenant(request)
+    if not UPLOAD_FLIGHTS.pending(docset_key):
+        limited = _rate_limit(tenant, "upload", cost=len(pdfs))
+        if limited:
+            return limited
+
+    # Identical concurrent uploads share one ingestion (and its index)
     try:
-        vectorstore = _build_vectorstore_from_pdfs(files)
+        index, doc_stats, page_stores = await UPLOAD_FLIGHTS.do(docset_key, lambda: SCHEDULER.run(
+            tenant, "upload", PRIORITY_BULK, len(pdfs), _build_index_from_pdfs, pdfs,
+        ))
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"Failed to process PDFs: {e}"})
 
+    for store in page_stores:
+        DOCUMENTS[store.doc_id] = store
+
     session_id = str(uuid.uuid4())
-    SESSIONS[session_id] = {"vectorstore": vectorstore, "history": []}
-    return {"session_id": session_id, "message": "PDFs indexed successfully."}
+    SESSIONS[session_id] = {
+        "index": index,
+        "docset_key": docset_key,
+        "documents": doc_stats,
+        "history": ChatMemory(),
+    }
+    return {"session_id": session_id, "message": "PDFs indexed successfully.", "documents": doc_stats}
 
 @app.post("/ask")
-async def ask_question(body: AskBody):
+async def ask_question(request: Request, body: AskBody):
+    if body.page_from is not None and body.page_to is not None and body.page_from > body.page_to:
+        return JSONResponse(status_code=400, content={"error": "page_from must not be greater than page_to"})
+
     try:
-        chain, history = _get_or_create_chain(body.session_id)
+        # Building the chain may import LangChain if warm-up has not finished; keep it off the event loop
+        chain, history = await asyncio.to_thread(
+            _get_or_create_chain, body.session_id, body.filenames, body.page_from, body.page_to,
+        )
     except Exception as e:
         return JSONResponse(status_code=400, content={"error": str(e)})
 
-    # Prepare chat history as a list of tuples (user, ai)
-    chat_history = [(u, a) for u, a in history]
+    tenant = _tenant(request, body.session_id)
+    limited = _rate_limit(tenant, "ask")
+    if limited:
+        return limited
+
+    # Prepare chat history as a list of tuples (user, ai): summary + recent window
+    chat_history = history.chat_history()
+    prompt_tokens = _count_tokens(body.question) + history.history_tokens()
 
     try:
-        result = chain.invoke({"question": body.question, "chat_history": chat_history})
+        # Identical concurrent questions on the same documents share one LLM call
+        filters = f"{sorted(body.filenames or [])}:{body.page_from}:{body.page_to}"
+        key = _ask_key(SESSIONS[body.session_id]["docset_key"], body.question, chat_history, filters)
+        inputs = {"question": body.question, "chat_history": chat_history}
+        # A repeat of an in-flight question from the same session (e.g. a
+        # double-click) shares the answer but must not record the turn twice
+        turn_key = (body.session_id, key)
+        record_turn = turn_key not in PENDING_TURNS
+        if record_turn:
+            PENDING_TURNS.add(turn_key)
+        try:
+            result = await ASK_FLIGHTS.do(key, lambda: SCHEDULER.run(
+                tenant, "ask", PRIORITY_INTERACTIVE, 1, chain.invoke, inputs,
+            ))
+        finally:
+            if record_turn:
+                PENDING_TURNS.discard(turn_key)
         answer = result["answer"]
-        # Update history
-        history.append((body.question, answer))
+        # Update history (summarizes only when a batch of turns falls out of the window)
+        if record_turn:
+            evicted = history.add_turn(body.question, answer, prompt_tokens)
+            if evicted:
+                # The summary is a Gemini call too: schedule it and charge the tenant's budget
+                _bucket(tenant, "ask").charge(1)
+                await SCHEDULER.run(tenant, "ask", PRIORITY_INTERACTIVE, 1, history.summarize, evicted)
 
         # Return sources
         sources = []
@@ -156,22 +1027,88 @@ async def ask_question(body: AskBody):
             meta = d.metadata or {}
             sources.append({
                 "source": meta.get("source"),
+                "filename": meta.get("filename"),
+                "doc_id": meta.get("doc_id"),
+                "chunk_id": meta.get("chunk_id"),
                 "page": meta.get("page"),
+                "locations": meta.get("locations", []),
                 "snippet": d.page_content[:300]
             })
 
-        return {"answer": answer, "sources": sources}
+        return {"answer": answer, "sources": sources, "usage": history.stats()}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": f"LLM error: {e}"})
 
 @app.post("/reset")
 async def reset_session(body: ResetBody):
     if body.session_id in SESSIONS:
-        SESSIONS[body.session_id]["history"] = []
+        SESSIONS[body.session_id]["history"].clear()
         return {"message": "History cleared."}
     return JSONResponse(status_code=400, content={"error": "Invalid session_id"})
 
 
+@app.get("/documents/{doc_id}/pages/{page}")
+async def get_page(request: Request, doc_id: str, page: int, chunk_id: Optional[str] = None):
+    store = DOCUMENTS.get(doc_id)
+    if store is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown document"})
+    text = store.page(page)
+    if text is None:
+        return JSONResponse(status_code=404, content={"error": f"Page {page} has no indexed text"})
+
+    highlight = None
+    span = store.chunk_spans.get(chunk_id) if chunk_id else None
+    if span and span[0] == page:
+        highlight = {"start": span[1], "end": span[2]}
+
+    # doc_id is a content hash; the ingestion settings also shape the page text
+    etag = f'"{doc_id}-{_ingestion_version()}-{page}-{chunk_id or ""}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    if highlight:
+        start, end = highlight["start"], highlight["end"]
+        page_html = (
+            html.escape(text[:start]) + "<mark>" + html.escape(text[start:end]) + "</mark>" + html.escape(text[end:])
+        )
+    else:
+        page_html = html.escape(text)
+    return JSONResponse(
+        content={
+            "doc_id": doc_id,
+            "filename": store.filename,
+            "page": page,
+            "text": text,
+            "highlight": highlight,
+            "html": page_html,
+        },
+        headers=headers,
+    )
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    info = {
+        "uptime_seconds": round(time.monotonic() - PROCESS_START, 3),
+        "warmup_seconds": WARMUP["seconds"],
+    }
+    if WARMUP["ready"]:
+        return {"status": "ready", **info}
+    if WARMUP["error"]:
+        # Retry in the background; the lazy path may well succeed now
+        if not WARMUP["running"]:
+            WARMUP["running"] = True
+            _spawn(asyncio.to_thread(_warm_up))
+        return JSONResponse(status_code=503, content={"status": "failed", "error": WARMUP["error"], **info})
+    return JSONResponse(status_code=503, content={"status": "warming", **info})
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        **METRICS,
+        "scheduler": {"active": SCHEDULER.active, "queued": len(SCHEDULER._heap), "slots": SCHEDULER.slots},
+    }
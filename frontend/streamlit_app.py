@@ -1,8 +1,11 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import os
-from typing import List
+from typing import List, Optional
 import tempfile
+import threading
+import time
 import uuid
 from datetime import datetime
 
@@ -208,6 +211,23 @@ st.markdown("""
         background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
     }
     
+    /* Cited page preview */
+    .page-preview {
+        white-space: pre-wrap;
+        max-height: 300px;
+        overflow-y: auto;
+        font-size: 0.85rem;
+        background: #fafafa;
+        border: 1px solid #e9ecef;
+        border-radius: 8px;
+        padding: 0.8rem;
+        margin-bottom: 1rem;
+    }
+    
+    .page-preview mark {
+        background: #fff3a3;
+    }
+    
     /* Metric styling */
     .metric-container {
         background: white;
@@ -227,19 +247,125 @@ BACKEND_URLS = [
     "http://0.0.0.0:8000"
 ]
 
+HEALTH_POLL_INTERVAL = 10  # seconds
+UPLOAD_CHUNK_SIZE = 256 * 1024  # bytes
+
+@st.cache_resource
+def get_http_adapter() -> HTTPAdapter:
+    """Keep-alive connection pool shared by every browser session (urllib3's pool is thread-safe)"""
+    return HTTPAdapter(pool_connections=4, pool_maxsize=8)
+
+def get_http_session() -> requests.Session:
+    """Per-browser HTTP session, reused across reruns; connections come from the shared pool"""
+    # requests.Session itself is not thread-safe, and script runs of different
+    # browser sessions execute on different threads
+    if "http_session" not in st.session_state:
+        session = requests.Session()
+        adapter = get_http_adapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # Stable per-browser id: the backend keys rate limits and fair queuing on it
+        session.headers["X-Client-Id"] = str(uuid.uuid4())
+        st.session_state.http_session = session
+    return st.session_state.http_session
+
+class BackendMonitor:
+    """Polls the backend's /health endpoint in a background thread.
+
+    Reruns read the last known status instead of making network calls.
+    """
+
+    def __init__(self, urls: List[str], interval: float = HEALTH_POLL_INTERVAL):
+        self.urls = urls
+        self.interval = interval
+        self.url = urls[0]
+        self.healthy = False
+        self.checked_at: Optional[float] = None
+        # requests.Session is not thread-safe; the poller keeps its own
+        self._session = requests.Session()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.poll()  # first probe up front so API_BASE is right on first render
+        self._thread.start()
+
+    def poll(self):
+        session = self._session
+        # Try the last working URL first
+        for url in [self.url] + [u for u in self.urls if u != self.url]:
+            try:
+                response = session.get(f"{url}/health", timeout=2)
+                if response.status_code == 200:
+                    self.url, self.healthy = url, True
+                    break
+            except requests.RequestException:
+                continue
+        else:
+            self.healthy = False
+        self.checked_at = time.time()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+@st.cache_resource
+def get_backend_monitor() -> BackendMonitor:
+    """Start the backend health poller once per Streamlit server"""
+    monitor = BackendMonitor(BACKEND_URLS)
+    monitor.start()
+    return monitor
+
 def get_backend_url():
-    """Try to find a working backend URL"""
-    for url in BACKEND_URLS:
-        try:
-            response = requests.get(f"{url}/docs", timeout=3)
-            if response.status_code == 200:
-                return url
-        except:
-            continue
-    return BACKEND_URLS[0]
+    """Return the last backend URL that answered /health"""
+    return get_backend_monitor().url
 
 API_BASE = get_backend_url()
 
+@st.cache_data(show_spinner=False, max_entries=256)
+def _fetch_page_cached(doc_id: str, page: int, chunk_id: Optional[str] = None):
+    # Raises on failure so that only successful responses are cached
+    response = get_http_session().get(
+        f"{API_BASE}/documents/{doc_id}/pages/{page}",
+        params={"chunk_id": chunk_id} if chunk_id else None,
+        timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()
+
+def fetch_page(doc_id: str, page: int, chunk_id: Optional[str] = None):
+    """Fetch a cited page with the matched chunk highlighted (cached per page/chunk)"""
+    try:
+        return _fetch_page_cached(doc_id, page, chunk_id)
+    except (requests.RequestException, ValueError):
+        return None
+
+def _quote_filename(name: str) -> str:
+    """Escape a filename for a multipart header the way browsers do"""
+    return name.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+def _stream_multipart(files: List, boundary: str, on_progress=None):
+    """Yield a multipart/form-data body chunk by chunk instead of building it in memory"""
+    total = sum(file.size for file in files) or 1
+    sent = 0
+    for file in files:
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="files"; filename="{_quote_filename(file.name)}"\r\n'
+            "Content-Type: application/pdf\r\n\r\n"
+        ).encode()
+        file.seek(0)
+        while True:
+            chunk = file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            sent += len(chunk)
+            if on_progress:
+                on_progress(sent / total, file.name)
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
 def main():
     # Professional header
     st.markdown('<div class="main-container">', unsafe_allow_html=True)
@@ -269,7 +395,7 @@ def main():
             
             # File details
             for i, file in enumerate(uploaded_files):
-                file_size = len(file.getvalue()) / 1024  # KB
+                file_size = file.size / 1024  # KB
                 st.info(f"**{file.name}** ({file_size:.1f} KB)")
             
             if st.button("🚀 Process Documents", type="primary", use_container_width=True, key="process_docs"):
@@ -318,6 +444,8 @@ def main():
             st.session_state.session_id = None
         if 'chat_history' not in st.session_state:
             st.session_state.chat_history = []
+        if 'documents' not in st.session_state:
+            st.session_state.documents = []
         
         # Chat container
         with st.container():
@@ -357,10 +485,19 @@ def main():
                         
                         if 'sources' in message and message['sources']:
                             sources_text = " | ".join([
-                                f"{src.get('source', 'PDF').split('/')[-1]} p.{src.get('page', 'N/A')}"
+                                f"{src.get('filename') or (src.get('source') or 'PDF').split('/')[-1]} p.{src.get('page', 'N/A')}"
                                 for src in message['sources']
                             ])
                             st.markdown(f'<div class="source-info">📚 Sources: {sources_text}</div>', unsafe_allow_html=True)
+                            
+                            with st.expander("📄 View cited pages"):
+                                for src in message['sources']:
+                                    if not src.get('doc_id'):
+                                        continue
+                                    page = fetch_page(src['doc_id'], src['page'], src.get('chunk_id'))
+                                    if page:
+                                        st.markdown(f"**{page['filename']}** p.{page['page']}")
+                                        st.markdown(f'<div class="page-preview">{page["html"]}</div>', unsafe_allow_html=True)
             
             st.markdown('</div>', unsafe_allow_html=True)
         
@@ -373,6 +510,16 @@ def main():
                 key="question_input"
             )
             
+            with st.expander("🔎 Limit search to specific documents or pages"):
+                filenames = sorted({doc['filename'] for doc in st.session_state.documents})
+                st.multiselect("Documents", filenames, key="filter_filenames",
+                               help="Leave empty to search all documents")
+                col_from, col_to = st.columns(2)
+                with col_from:
+                    st.number_input("From page", min_value=0, value=None, step=1, key="filter_page_from")
+                with col_to:
+                    st.number_input("To page", min_value=0, value=None, step=1, key="filter_page_to")
+            
             col_ask, col_clear = st.columns([1, 1])
             with col_ask:
                 if st.button("🤔 Ask AI", type="primary", use_container_width=True, key="main_ask"):
@@ -406,16 +553,15 @@ def main():
         st.markdown("---")
         st.markdown("### 🔧 System Status")
         
-        try:
-            response = requests.get(f"{API_BASE}/docs", timeout=5)
-            if response.status_code == 200:
-                st.success("✅ Backend Connected")
-                st.markdown(f"**URL**: {API_BASE}")
-            else:
-                st.error("❌ Backend Error")
-        except:
+        monitor = get_backend_monitor()
+        if monitor.healthy:
+            st.success("✅ Backend Connected")
+            st.markdown(f"**URL**: {monitor.url}")
+        else:
             st.error("❌ Backend Unreachable")
             st.info("Check if server is running")
+        if monitor.checked_at:
+            st.caption(f"Last checked {datetime.fromtimestamp(monitor.checked_at):%H:%M:%S}")
         
         # Metrics
         st.markdown("---")
@@ -440,21 +586,25 @@ def process_pdfs(files: List):
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            # Prepare files for upload
-            files_data = []
-            for i, file in enumerate(files):
-                files_data.append(('files', (file.name, file.getvalue(), 'application/pdf')))
-                progress_bar.progress((i + 1) / len(files))
-                status_text.text(f"Preparing {file.name}...")
+            def on_progress(fraction, name):
+                progress_bar.progress(min(fraction, 1.0))
+                if fraction < 1:
+                    status_text.text(f"Uploading {name}...")
+                else:
+                    status_text.text("Indexing documents on AI backend...")
             
-            status_text.text("Uploading to AI backend...")
-            
-            # Upload to backend
-            response = requests.post(f"{API_BASE}/upload", files=files_data)
+            # Stream files to the backend without loading them all into memory
+            boundary = uuid.uuid4().hex
+            response = get_http_session().post(
+                f"{API_BASE}/upload",
+                data=_stream_multipart(files, boundary, on_progress),
+                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            )
             
             if response.status_code == 200:
                 data = response.json()
                 st.session_state.session_id = data['session_id']
+                st.session_state.documents = data.get('documents', [])
                 st.session_state.chat_history.append({
                     'type': 'bot',
                     'content': f"✅ Successfully processed {len(files)} document(s)! I'm now ready to answer your questions about them. What would you like to know?",
@@ -465,6 +615,12 @@ def process_pdfs(files: List):
                 status_text.text("✅ Processing complete!")
                 
                 st.success(f"🎉 {len(files)} document(s) processed successfully!")
+                for doc in data.get('documents', []):
+                    if doc.get('ocr_pages') or doc.get('skipped_pages'):
+                        st.info(
+                            f"**{doc['filename']}**: {doc['text_pages']} text page(s), "
+                            f"{doc['ocr_pages']} OCR'd, {doc['skipped_pages']} skipped (no text)"
+                        )
                 st.balloons()
             else:
                 st.error(f"❌ Error processing documents: {response.text}")
@@ -489,9 +645,12 @@ def ask_question(question: str):
         
         with st.spinner("🤔 Analyzing your question with AI..."):
             # Send question to backend
-            response = requests.post(f"{API_BASE}/ask", json={
+            response = get_http_session().post(f"{API_BASE}/ask", json={
                 'session_id': st.session_state.session_id,
-                'question': question
+                'question': question,
+                'filenames': st.session_state.get('filter_filenames') or None,
+                'page_from': st.session_state.get('filter_page_from'),
+                'page_to': st.session_state.get('filter_page_to'),
             })
             
             if response.status_code == 200:
@@ -511,12 +670,13 @@ def reset_session():
     """Reset the current session"""
     if st.session_state.session_id:
         try:
-            response = requests.post(f"{API_BASE}/reset", json={
+            response = get_http_session().post(f"{API_BASE}/reset", json={
                 'session_id': st.session_state.session_id
             })
             if response.status_code == 200:
                 st.session_state.session_id = None
                 st.session_state.chat_history = []
+                st.session_state.documents = []
                 st.success("🔄 Session reset successfully!")
             else:
                 st.error("❌ Error resetting session")
@@ -2,15 +2,35 @@
 """
 Gemini PDF Assistant Launcher
 Automatically starts both backend and frontend services
+
+Usage:
+    python run_app.py                          # development (auto-reload)
+    python run_app.py --supervise              # production supervisor mode
 """
 
+import argparse
+import logging
 import subprocess
 import sys
+import threading
 import time
+import urllib.request
 import webbrowser
 import os
+from logging.handlers import RotatingFileHandler
 from pathlib import Path
 
+BACKEND_PORT = 8000
+FRONTEND_PORT = 8501
+BACKEND_HEALTH_URL = f"http://127.0.0.1:{BACKEND_PORT}/health"
+FRONTEND_HEALTH_URL = f"http://127.0.0.1:{FRONTEND_PORT}/_stcore/health"
+
+STARTUP_TIMEOUT = 60  # seconds to wait for both services to become healthy
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+RESTART_BACKOFF_MAX = 30  # seconds
+STABLE_UPTIME = 60  # a child running this long resets its restart backoff
+
 def check_dependencies():
     """Check if required packages are installed"""
     try:
@@ -34,132 +54,257 @@ def check_env_file():
         return False
     return True
 
-def start_backend():
-    """Start the FastAPI backend"""
-    print("🚀 Starting FastAPI backend...")
-    backend_cmd = [
-        sys.executable, "-m", "uvicorn", 
-        "backend.app:app", 
-        "--reload", 
-        "--host", "0.0.0.0", 
-        "--port", "8000"
-    ]
-    
-    try:
-        backend_process = subprocess.Popen(
-            backend_cmd,
+def make_logger(name, log_dir):
+    """Rotating file logger for a child process' output"""
+    log_dir.mkdir(parents=True, exist_ok=True)
+    logger = logging.getLogger(f"launcher.{name}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = RotatingFileHandler(
+            log_dir / f"{name}.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(handler)
+    return logger
+
+class Service:
+    """A child process whose output is drained into a rotating log file"""
+
+    def __init__(self, name, cmd, health_url, log_dir):
+        self.name = name
+        self.cmd = cmd
+        self.health_url = health_url
+        self.logger = make_logger(name, log_dir)
+        self.process = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self):
+        """Start the process and a thread that drains its output"""
+        # Read stdout/stderr continuously so a chatty child never blocks on a full pipe
+        self.process = subprocess.Popen(
+            self.cmd,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+            stderr=subprocess.STDOUT,
+            # Never let an undecodable byte kill the drain thread
+            encoding="utf-8",
+            errors="replace",
+            bufsize=1,
         )
-        print("✅ Backend started successfully")
-        return backend_process
-    except Exception as e:
-        print(f"❌ Failed to start backend: {e}")
-        return None
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        threading.Thread(target=self._drain, args=(self.process,), daemon=True).start()
+        return self.process
 
-def start_frontend():
-    """Start the Streamlit frontend"""
-    print("🎨 Starting Streamlit frontend...")
+    def _drain(self, process):
+        # Keep reading even if logging fails, or the child blocks on a full pipe
+        for line in process.stdout:
+            try:
+                self.logger.info(line.rstrip())
+            except Exception:
+                pass
+        process.stdout.close()
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_healthy(self):
+        try:
+            with urllib.request.urlopen(self.health_url, timeout=2) as response:
+                return response.status == 200
+        except Exception:
+            return False
+
+    def stop(self):
+        if self.is_running():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+def backend_service(log_dir, supervise=False, workers=1):
+    """FastAPI backend: auto-reload in development, no reload in supervisor mode"""
+    backend_cmd = [
+        sys.executable, "-m", "uvicorn",
+        "backend.app:app",
+        "--host", "0.0.0.0",
+        "--port", str(BACKEND_PORT),
+    ]
+    if supervise:
+        backend_cmd += ["--workers", str(workers)]
+    else:
+        backend_cmd.append("--reload")
+    return Service("backend", backend_cmd, BACKEND_HEALTH_URL, log_dir)
+
+def frontend_service(log_dir, supervise=False):
+    """Streamlit frontend"""
     frontend_cmd = [
         sys.executable, "-m", "streamlit", "run",
         "frontend/streamlit_app.py",
-        "--server.port", "8501"
+        "--server.port", str(FRONTEND_PORT),
     ]
-    
+    if supervise:
+        frontend_cmd += ["--server.headless", "true"]
+    return Service("frontend", frontend_cmd, FRONTEND_HEALTH_URL, log_dir)
+
+def start_service(service, label):
+    """Start a service and report the result"""
+    print(f"{label} Starting {service.name}...")
     try:
-        frontend_process = subprocess.Popen(
-            frontend_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        print("✅ Frontend started successfully")
-        return frontend_process
+        service.start()
+        print(f"✅ {service.name.capitalize()} process started (pid {service.process.pid})")
+        return True
     except Exception as e:
-        print(f"❌ Failed to start frontend: {e}")
-        return None
+        print(f"❌ Failed to start {service.name}: {e}")
+        return False
 
-def wait_for_services():
-    """Wait for services to be ready"""
+def wait_for_services(services, timeout=STARTUP_TIMEOUT):
+    """Wait until every service answers its health check"""
     print("⏳ Waiting for services to be ready...")
-    time.sleep(5)  # Give services time to start
+    deadline = time.monotonic() + timeout
+    pending = list(services)
+    while pending and time.monotonic() < deadline:
+        for service in list(pending):
+            if not service.is_running():
+                print(f"❌ {service.name.capitalize()} exited during startup (see its log)")
+                return False
+            if service.is_healthy():
+                print(f"✅ {service.name.capitalize()} is ready")
+                pending.remove(service)
+        if pending:
+            time.sleep(0.25)
+    if pending:
+        print(f"❌ Timed out waiting for: {', '.join(s.name for s in pending)}")
+        return False
+    return True
+
+def schedule_restart(service, reason):
+    """Schedule the next restart attempt with exponential backoff"""
+    delay = min(2 ** service.failures, RESTART_BACKOFF_MAX)
+    service.failures += 1
+    service.restart_at = time.monotonic() + delay
+    print(f"❌ {service.name.capitalize()} {reason}; restarting in {delay}s")
+
+def supervise(services):
+    """Restart crashed services with exponential backoff until interrupted"""
+    while True:
+        time.sleep(1)
+        now = time.monotonic()
+        for service in services:
+            if service.is_running():
+                continue
+            if service.restart_at is None:
+                if now - service.started_at >= STABLE_UPTIME:
+                    service.failures = 0
+                schedule_restart(service, f"exited with code {service.process.returncode}")
+            elif now >= service.restart_at:
+                if not start_service(service, "🔁"):
+                    schedule_restart(service, "failed to start")
 
 def open_browser():
     """Open the application in browser"""
     print("🌐 Opening application in browser...")
     try:
-        webbrowser.open("http://localhost:8501")
+        webbrowser.open(f"http://localhost:{FRONTEND_PORT}")
         print("✅ Browser opened successfully")
     except Exception as e:
         print(f"⚠️  Could not open browser automatically: {e}")
-        print("Please manually open: http://localhost:8501")
+        print(f"Please manually open: http://localhost:{FRONTEND_PORT}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Start the Gemini PDF Assistant")
+    parser.add_argument("--supervise", action="store_true",
+                        help="production mode: no auto-reload, restart crashed services")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="backend worker processes in supervisor mode (only 1 is supported: "
+                             "sessions and indexes live in each worker's memory)")
+    parser.add_argument("--log-dir", default="logs", help="directory for rotating service logs")
+    parser.add_argument("--no-browser", action="store_true", help="do not open a browser")
+    args = parser.parse_args()
+    if args.workers != 1:
+        # uvicorn has no session affinity, so /ask would land on workers that
+        # never saw the upload and fail with "Invalid session_id"
+        parser.error("--workers must be 1: sessions, document stores and rate limits are kept "
+                     "in process memory and are not shared between workers")
+    return args
 
 def main():
     """Main launcher function"""
+    args = parse_args()
+
     print("=" * 50)
     print("📚 Gemini PDF Assistant Launcher")
     print("=" * 50)
-    
+
     # Check dependencies
     if not check_dependencies():
         sys.exit(1)
-    
+
     # Check environment file
     check_env_file()
-    
+
+    log_dir = Path(args.log_dir)
+    backend = backend_service(log_dir, args.supervise, args.workers)
+    frontend = frontend_service(log_dir, args.supervise)
+    services = [backend, frontend]
+
     # Start backend
-    backend_process = start_backend()
-    if not backend_process:
+    if not start_service(backend, "🚀"):
         sys.exit(1)
-    
+
     # Start frontend
-    frontend_process = start_frontend()
-    if not frontend_process:
-        backend_process.terminate()
+    if not start_service(frontend, "🎨"):
+        backend.stop()
         sys.exit(1)
-    
-    # Wait for services
-    wait_for_services()
-    
-    # Open browser
-    open_browser()
-    
-    print("\n" + "=" * 50)
-    print("🎉 Application is running!")
-    print("📱 Frontend: http://localhost:8501")
-    print("🔧 Backend:  http://localhost:8000")
-    print("📖 API Docs: http://localhost:8000/docs")
-    print("=" * 50)
-    print("Press Ctrl+C to stop all services")
-    
+
     try:
-        # Keep the launcher running
-        while True:
-            time.sleep(1)
-            
-            # Check if processes are still running
-            if backend_process.poll() is not None:
-                print("❌ Backend process stopped unexpectedly")
-                break
-            if frontend_process.poll() is not None:
-                print("❌ Frontend process stopped unexpectedly")
-                break
-                
+        # Wait for services
+        if not wait_for_services(services):
+            for service in services:
+                service.stop()
+            print(f"📄 Logs: {log_dir.resolve()}")
+            sys.exit(1)
+
+        # Open browser
+        if not args.supervise and not args.no_browser:
+            open_browser()
+
+        print("\n" + "=" * 50)
+        print("🎉 Application is running!")
+        print(f"📱 Frontend: http://localhost:{FRONTEND_PORT}")
+        print(f"🔧 Backend:  http://localhost:{BACKEND_PORT}")
+        print(f"📖 API Docs: http://localhost:{BACKEND_PORT}/docs")
+        print(f"📄 Logs:     {log_dir.resolve()}")
+        print("=" * 50)
+        print("Press Ctrl+C to stop all services")
+
+        if args.supervise:
+            supervise(services)
+        else:
+            # Keep the launcher running
+            while True:
+                time.sleep(1)
+
+                # Check if processes are still running
+                if not backend.is_running():
+                    print("❌ Backend process stopped unexpectedly")
+                    break
+                if not frontend.is_running():
+                    print("❌ Frontend process stopped unexpectedly")
+                    break
+
     except KeyboardInterrupt:
         print("\n🛑 Shutting down services...")
-        
-        # Terminate processes
-        if backend_process:
-            backend_process.terminate()
-            print("✅ Backend stopped")
-        
-        if frontend_process:
-            frontend_process.terminate()
-            print("✅ Frontend stopped")
-        
-        print("👋 Goodbye!")
+
+    # Terminate processes
+    for service in services:
+        service.stop()
+        print(f"✅ {service.name.capitalize()} stopped")
+
+    print("👋 Goodbye!")
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,365 @@
+"""Unit tests for the backend's ingestion, memory and scheduling helpers."""
+
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+import backend.app as app_module  # noqa: E402
+
+def test_chat_memory_evicts_in_batches():
+    memory = app_module.ChatMemory(max_turns=6, token_budget=100_000)
+    evictions = [len(memory.add_turn(f"q{i}", f"a{i}", 1)) for i in range(12)]
+
+    # Overflowing the window halves it, so only every few turns needs a summary
+    assert evictions == [0] * 6 + [4] + [0] * 3 + [4] + [0]
+    assert [q for q, _ in memory.turns] == ["q8", "q9", "q10", "q11"]
+    assert memory.prompt_tokens == 12
+
+def test_summary_started_before_reset_is_discarded(monkeypatch):
+    memory = app_module.ChatMemory(max_turns=2, token_budget=100_000)
+
+    class _ResettingLLM:
+        def invoke(self, prompt):
+            memory.clear()
+            return type("Message", (), {"content": "old conversation"})()
+
+    monkeypatch.setattr(app_module, "_get_llm", lambda: _ResettingLLM())
+    memory.summarize([("q0", "a0")])
+    assert memory.summary == ""
+    assert memory.summarizations == 0
+
+class _FakeRequest:
+    def __init__(self, headers=None, host="10.0.0.1"):
+        self.headers = headers or {}
+        self.client = type("Client", (), {"host": host})()
+
+def test_token_bucket_charges_full_cost():
+    bucket = app_module.TokenBucket(0.2, 10)
+    assert bucket.take(4) == 0
+    # Costs above capacity wait for a full bucket, then leave it in debt
+    assert bucket.take(40) > 0
+    bucket.tokens = bucket.capacity
+    assert bucket.take(40) == 0
+    assert bucket.take(1) >= 31 / 0.2 - 1
+
+def test_unknown_api_keys_are_not_trusted(monkeypatch):
+    monkeypatch.setattr(app_module, "API_KEYS", {"team-key"})
+    assert app_module._tenant(_FakeRequest({"x-api-key": "team-key"})) == "key:team-key"
+    assert app_module._tenant(_FakeRequest({"x-api-key": "random"}), "s1") == "session:s1"
+    assert app_module._tenant(_FakeRequest({"x-api-key": "random"})) == "client:10.0.0.1"
+
+def test_browser_client_id_is_preferred_over_session_and_ip():
+    request = _FakeRequest({"x-client-id": "browser-1"})
+    assert app_module._tenant(request) == "browser:browser-1"
+    assert app_module._tenant(request, "s1") == "browser:browser-1"
+
+def test_idle_buckets_are_swept(monkeypatch):
+    monkeypatch.setattr(app_module, "BUCKETS", {})
+    monkeypatch.setattr(app_module, "SWEEP_INTERVAL", 0)
+    app_module._bucket("client:a", "ask")
+    app_module._bucket("client:b", "ask").take(1)
+    app_module._bucket("client:c", "ask")
+    assert set(app_module.BUCKETS) == {("client:b", "ask"), ("client:c", "ask")}
+
+class _Chunk:
+    def __init__(self, text, doc_id="a", page=0):
+        self.page_content = text
+        self.metadata = {"doc_id": doc_id, "filename": f"{doc_id}.pdf", "page": page, "chunk_id": f"{doc_id}:{page}"}
+
+def _words(n, seed):
+    import random
+
+    rng = random.Random(seed)
+    vocab = [f"word{i}" for i in range(500)]
+    return [rng.choice(vocab) for _ in range(n)]
+
+def test_dedup_merges_reformatted_copies():
+    text = " ".join(_words(200, 1))
+    chunks = [_Chunk(text, "a", 0), _Chunk(text.upper().replace(" ", "\n  "), "b", 3)]
+    kept = app_module._dedup_chunks(chunks)
+    assert len(kept) == 1
+    assert [loc["doc_id"] for loc in kept[0].metadata["locations"]] == ["a", "b"]
+
+def test_dedup_keeps_chunks_that_really_differ():
+    for seed in range(50):
+        words = _words(200, seed)
+        changed = list(words)
+        for i in (20, 100, 180):
+            changed[i] = "different"
+        kept = app_module._dedup_chunks([_Chunk(" ".join(words)), _Chunk(" ".join(changed))])
+        assert len(kept) == 2
+
+    table = "Revenue 2022 1200 costs 800 margin 400 " * 20
+    kept = app_module._dedup_chunks([_Chunk(table), _Chunk(table.replace("1200", "1300", 1))])
+    assert len(kept) == 2
+
+class _Doc:
+    def __init__(self, page_content, metadata):
+        self.page_content = page_content
+        self.metadata = metadata
+
+class _FakeStore:
+    """Mimics FAISS: docs are ranked in list order, ``filter`` applies to the first ``fetch_k``."""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.index = type("Index", (), {"ntotal": len(docs)})()
+
+    def similarity_search_with_score_by_vector(self, vector, k, filter=None, fetch_k=20):
+        ranked = [(doc, float(i)) for i, doc in enumerate(self.docs)]
+        if filter is not None:
+            ranked = [(doc, score) for doc, score in ranked[:fetch_k] if filter(doc.metadata)]
+        return ranked[:k]
+
+class _FakeEmbeddings:
+    def embed_query(self, text):
+        return [1.0, 0.0]
+
+def test_search_cites_the_filtered_document_for_merged_chunks():
+    loc_a = {"doc_id": "a", "filename": "a.pdf", "page": 2, "chunk_id": "a:0"}
+    loc_b = {"doc_id": "b", "filename": "b.pdf", "page": 7, "chunk_id": "b:3"}
+    shared = _Doc("shared disclaimer text", {**loc_a, "locations": [loc_a, loc_b]})
+    index = app_module.DocumentIndex(
+        _FakeEmbeddings(),
+        stores={"a": _FakeStore([shared]), "b": _FakeStore([shared])},
+        centroids={},
+        filenames={"a": "a.pdf", "b": "b.pdf"},
+    )
+
+    [hit] = index.search("question", filenames=["b.pdf"])
+    assert (hit.metadata["doc_id"], hit.metadata["filename"], hit.metadata["page"]) == ("b", "b.pdf", 7)
+    assert index.search("question", filenames=["b.pdf"], page_range=(0, 5)) == []
+
+def test_page_filter_finds_chunks_ranked_beyond_the_top_hits():
+    docs = []
+    for i in range(40):
+        loc = {"doc_id": "a", "filename": "a.pdf", "page": 1 if i == 30 else 0, "chunk_id": f"a:{i}"}
+        docs.append(_Doc(f"chunk {i}", {**loc, "locations": [loc]}))
+    index = app_module.DocumentIndex(
+        _FakeEmbeddings(), stores={"a": _FakeStore(docs)}, centroids={}, filenames={"a": "a.pdf"},
+    )
+
+    hits = index.search("question", k=4, page_range=(1, 1))
+    assert [hit.page_content for hit in hits] == ["chunk 30"]
+
+def test_ask_rejects_inverted_page_range():
+    import pytest
+
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app_module.app)
+    response = client.post("/ask", json={"session_id": "x", "question": "q", "page_from": 5, "page_to": 2})
+    assert response.status_code == 400
+
+def test_single_flight_runs_identical_calls_once():
+    import asyncio
+
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        flights = app_module.SingleFlight()
+        results = await asyncio.gather(*(flights.do("k", work) for _ in range(5)))
+        return flights, results
+
+    flights, results = asyncio.run(main())
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+    assert flights._inflight == {}
+
+def test_single_flight_error_reaches_every_waiter_and_releases_the_key():
+    import asyncio
+
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def succeeding():
+        return "ok"
+
+    async def main():
+        flights = app_module.SingleFlight()
+        results = await asyncio.gather(*(flights.do("k", failing) for _ in range(3)), return_exceptions=True)
+        assert "k" not in flights._inflight
+        # The next caller starts a fresh call instead of inheriting the error
+        return results, await flights.do("k", succeeding)
+
+    results, retry = asyncio.run(main())
+    assert len(calls) == 1
+    assert [str(r) for r in results] == ["boom"] * 3
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert retry == "ok"
+
+def test_double_submitted_ask_records_the_turn_once(monkeypatch):
+    import asyncio
+    import time
+
+    invocations = []
+
+    class _SlowChain:
+        def invoke(self, inputs):
+            invocations.append(inputs["question"])
+            time.sleep(0.1)
+            return {"answer": "42", "source_documents": []}
+
+    memory = app_module.ChatMemory()
+    monkeypatch.setattr(app_module, "SESSIONS", {"s1": {"docset_key": "docs", "history": memory}})
+    monkeypatch.setattr(app_module, "_get_or_create_chain", lambda *args: (_SlowChain(), memory))
+    monkeypatch.setattr(app_module, "SCHEDULER", app_module.FairScheduler(2))
+    monkeypatch.setattr(app_module, "BUCKETS", {})
+
+    async def main():
+        body = app_module.AskBody(session_id="s1", question="meaning of life?")
+        return await asyncio.gather(*(app_module.ask_question(_FakeRequest(), body) for _ in range(2)))
+
+    responses = asyncio.run(main())
+    assert [r["answer"] for r in responses] == ["42", "42"]
+    assert invocations == ["meaning of life?"]
+    assert memory.turns == [("meaning of life?", "42")]
+    assert app_module.PENDING_TURNS == set()
+
+def _run_scheduled(jobs, slots=1, weights=None):
+    """Run ``(tenant, priority)`` jobs while a blocker holds every slot; return the execution order."""
+    import asyncio
+    import threading
+
+    order = []
+    gate = threading.Event()
+
+    async def main():
+        scheduler = app_module.FairScheduler(slots)
+        blockers = [asyncio.create_task(scheduler.run("key:blocker", "ask", 0, 1, gate.wait)) for _ in range(slots)]
+        await asyncio.sleep(0)
+        tasks = []
+        for tenant, priority in jobs:
+            tasks.append(asyncio.create_task(scheduler.run(tenant, "ask", priority, 1, order.append, tenant)))
+            await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(*blockers, *tasks)
+
+    asyncio.run(main())
+    return order
+
+def test_scheduler_serves_interactive_work_before_bulk_work():
+    order = _run_scheduled([
+        ("key:bulk", app_module.PRIORITY_BULK),
+        ("key:bulk2", app_module.PRIORITY_BULK),
+        ("key:ask", app_module.PRIORITY_INTERACTIVE),
+    ])
+    assert order == ["key:ask", "key:bulk", "key:bulk2"]
+
+def test_scheduler_shares_slots_by_tenant_weight(monkeypatch):
+    monkeypatch.setattr(app_module, "TENANT_WEIGHTS", {"heavy": 3.0})
+    jobs = [("key:heavy", 0), ("key:light", 0)] * 4
+    order = _run_scheduled(jobs)
+    # Start tags advance by 1/3 for the heavy tenant and by 1 for the light one
+    assert [t.split(":")[1] for t in order] == ["heavy", "light", "heavy", "heavy", "light", "heavy", "light", "light"]
+
+def test_scheduler_hands_slots_past_cancelled_waiters():
+    import asyncio
+
+    async def main():
+        scheduler = app_module.FairScheduler(1)
+        await scheduler._acquire("key:holder", 0, 1)
+        waiting = asyncio.create_task(scheduler._acquire("key:a", 0, 1))
+        handed = asyncio.create_task(scheduler._acquire("key:b", 0, 1))
+        last = asyncio.create_task(scheduler._acquire("key:c", 0, 1))
+        await asyncio.sleep(0)
+
+        # Cancelled while still queued: the slot skips it
+        waiting.cancel()
+        scheduler._release()
+        # Cancelled right after the slot was handed over: it passes the slot on
+        handed.cancel()
+        for task in (waiting, handed):
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.wait_for(last, 1)
+        assert scheduler.active == 1
+        scheduler._release()
+        assert scheduler.active == 0
+
+    asyncio.run(main())
+
+def test_rate_limited_upload_returns_retry_after(monkeypatch):
+    import pytest
+
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(app_module, "BUCKETS", {})
+    app_module._bucket("browser:b1", "upload").charge(app_module.UPLOAD_BURST)
+
+    client = TestClient(app_module.app)
+    response = client.post(
+        "/upload",
+        headers={"X-Client-Id": "b1"},
+        files=[("files", ("a.pdf", b"%PDF-1.4 not really", "application/pdf"))],
+    )
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+def _page_client(monkeypatch):
+    import pytest
+
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+
+    pages = [_Doc("Cover page", {"page": 0}), _Doc("Intro <b>bold</b> & more text", {"page": 1})]
+    store = app_module.PageStore("doc1", "a.pdf", pages)
+    store.add_chunk(_Doc("<b>bold</b> &", {"page": 1, "start_index": 6, "chunk_id": "doc1:0"}))
+    store.add_chunk(_Doc("no offset", {"page": 1, "chunk_id": "doc1:1"}))
+    monkeypatch.setattr(app_module, "DOCUMENTS", {"doc1": store})
+    return store, TestClient(app_module.app)
+
+def test_page_store_maps_chunks_to_page_spans(monkeypatch):
+    store, _ = _page_client(monkeypatch)
+    assert store.page(0) == "Cover page"
+    assert store.page(1) == "Intro <b>bold</b> & more text"
+    assert store.page(2) is None
+    assert store.chunk_spans == {"doc1:0": (1, 6, 19)}
+
+def test_page_endpoint_escapes_text_around_the_highlight(monkeypatch):
+    _, client = _page_client(monkeypatch)
+    body = client.get("/documents/doc1/pages/1", params={"chunk_id": "doc1:0"}).json()
+    assert body["highlight"] == {"start": 6, "end": 19}
+    assert body["html"] == "Intro <mark>&lt;b&gt;bold&lt;/b&gt; &amp;</mark> more text"
+
+    # A chunk from another page is not highlighted
+    other = client.get("/documents/doc1/pages/0", params={"chunk_id": "doc1:0"}).json()
+    assert other["highlight"] is None
+    assert other["html"] == "Cover page"
+
+def test_page_endpoint_revalidates_with_etag(monkeypatch):
+    _, client = _page_client(monkeypatch)
+    first = client.get("/documents/doc1/pages/1", params={"chunk_id": "doc1:0"})
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+    assert "max-age" in first.headers["Cache-Control"]
+
+    cached = client.get("/documents/doc1/pages/1", params={"chunk_id": "doc1:0"}, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == etag
+
+    # The highlighted chunk is part of the cache key
+    other = client.get("/documents/doc1/pages/1", headers={"If-None-Match": etag})
+    assert other.status_code == 200
+
+def test_page_endpoint_404s(monkeypatch):
+    _, client = _page_client(monkeypatch)
+    assert client.get("/documents/unknown/pages/0").status_code == 404
+    assert client.get("/documents/doc1/pages/9").status_code == 404
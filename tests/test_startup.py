@@ -0,0 +1,54 @@
+"""Startup-time checks for the FastAPI backend.
+
+Run from the repository root with ``python -m pytest`` (needs pytest and httpx).
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+HEAVY_MODULES = ["langchain", "langchain_community", "langchain_google_genai", "faiss", "google.generativeai"]
+
+def test_import_does_not_load_heavy_dependencies():
+    # Fresh interpreter so modules imported by other tests don't leak in
+    code = (
+        "import json, sys, time\n"
+        "t0 = time.perf_counter()\n"
+        "import backend.app\n"
+        "elapsed = time.perf_counter() - t0\n"
+        f"print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    env = {**os.environ, "GOOGLE_API_KEY": "test-key"}
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert result["loaded"] == []
+    assert result["elapsed"] < 2.0
+
+def test_health_answers_before_warm_up_finishes():
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+
+    import backend.app as backend_app
+
+    t0 = time.perf_counter()
+    with TestClient(backend_app.app) as client:
+        response = client.get("/health")
+        elapsed = time.perf_counter() - t0
+        assert response.status_code == 200
+        assert elapsed < 0.5
+
+        # Warm-up runs in the background, so readiness is not reported yet
+        ready = client.get("/ready")
+        assert ready.status_code == 503
+        assert ready.json()["status"] in ("warming", "failed")